@@ -66,6 +66,10 @@ class Dreamer(nn.Module):
             random=lambda: expl.Random(config, act_space),
             plan2explore=lambda: expl.Plan2Explore(config, self._wm, reward),
         )[config.expl_behavior]().to(self._config.device)
+        # eval inference is replayed from a captured cuda graph on steps
+        # without resets; None until first use, False once capture failed
+        self._use_graph = config.eval_cuda_graph and "cuda" in str(config.device)
+        self._graph = None
 
     def __call__(self, obs, reset, state=None, training=True):
         step = self._step
@@ -97,7 +101,16 @@ class Dreamer(nn.Module):
                     self._logger.video("train_openl", to_np(openl))
                 self._logger.write(fps=True)
         #print(obs)
-        policy_output, state = self._policy(obs, state, training)
+        if (
+            not training
+            and self._use_graph
+            and self._graph is not False
+            and state is not None
+            and not reset.any()
+        ):
+            policy_output, state = self._graph_policy(obs, state)
+        else:
+            policy_output, state = self._policy(obs, state, training)
 
         if training:
             self._step += len(reset)
@@ -115,6 +128,9 @@ class Dreamer(nn.Module):
         else:
             latent, action = state
         obs = self._wm.preprocess(obs)
+        return self._policy_step(obs, latent, action, training)
+
+    def _policy_step(self, obs, latent, action, training):
         embed = self._wm.encoder(obs)
         latent, _ = self._wm.dynamics.obs_step(
             latent, action, embed, obs["is_first"], self._config.collect_dyn_sample
@@ -143,6 +159,68 @@ class Dreamer(nn.Module):
         state = (latent, action)
         return policy_output, state
 
+    def _graph_policy(self, obs, state):
+        obs = self._wm.preprocess(obs)
+        latent, action = state
+        if self._graph is None or not self._graph_matches(obs, latent, action):
+            if not self._capture_policy(obs, latent, action):
+                return self._policy_step(obs, latent, action, False)
+        static_obs, static_latent, static_action = self._graph_inputs
+        for key, value in obs.items():
+            static_obs[key].copy_(value)
+        for key, value in latent.items():
+            static_latent[key].copy_(value)
+        static_action.copy_(action)
+        self._graph.replay()
+        # outputs live in the graph's memory pool and are overwritten by the
+        # next replay, so hand out copies
+        policy_output, (latent, action) = self._graph_outputs
+        policy_output = {k: v.clone() for k, v in policy_output.items()}
+        latent = {k: v.clone() for k, v in latent.items()}
+        return policy_output, (latent, action.clone())
+
+    def _graph_matches(self, obs, latent, action):
+        static_obs, static_latent, static_action = self._graph_inputs
+        return (
+            obs.keys() == static_obs.keys()
+            and all(v.shape == static_obs[k].shape for k, v in obs.items())
+            and all(v.shape == static_latent[k].shape for k, v in latent.items())
+            and action.shape == static_action.shape
+        )
+
+    def _capture_policy(self, obs, latent, action):
+        static_obs = {k: v.clone() for k, v in obs.items()}
+        static_latent = {k: v.clone() for k, v in latent.items()}
+        static_action = action.clone()
+        # argument validation in torch.distributions syncs with the host,
+        # which is not allowed while capturing
+        validate = torchd.Distribution._validate_args
+        torchd.Distribution.set_default_validate_args(False)
+        try:
+            stream = torch.cuda.Stream()
+            stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(stream):
+                for _ in range(3):
+                    self._policy_step(
+                        dict(static_obs), dict(static_latent), action.clone(), False
+                    )
+            torch.cuda.current_stream().wait_stream(stream)
+            graph = torch.cuda.CUDAGraph()
+            with torch.cuda.graph(graph):
+                outputs = self._policy_step(
+                    static_obs, static_latent, static_action, False
+                )
+        except RuntimeError as e:
+            print(f"CUDA graph capture failed, falling back to eager eval: {e}")
+            self._graph = False
+            return False
+        finally:
+            torchd.Distribution.set_default_validate_args(validate)
+        self._graph = graph
+        self._graph_inputs = (static_obs, static_latent, static_action)
+        self._graph_outputs = outputs
+        return True
+
     def _exploration(self, action, training):
         amount = self._config.expl_amount if training else self._config.eval_noise
         if amount == 0:
@@ -239,6 +317,7 @@ def make_env(config, mode):
     env = wrappers.UUID(env)
     if suite == "minecraft":
         env = wrappers.RewardObs(env)
+    env = wrappers.AutoReset(env)
     return env
 
 
@@ -369,6 +448,8 @@ def main(config):
             env.close()
         except Exception:
             pass
+    tools.flush_episodes()
+    logger.close()
 
 
 if __name__ == "__main__":
@@ -155,3 +155,31 @@ class UUID(gym.Wrapper):
         timestamp = datetime.datetime.now().strftime("%Y%m%dT%H%M%S")
         self.id = f"{timestamp}-{str(uuid.uuid4().hex)}"
         return self.env.reset()
+
+
+class AutoReset(gym.Wrapper):
+    def __init__(self, env):
+        super().__init__(env)
+
+    def step(self, action):
+        return self._autoreset(*self.env.step(action))
+
+    def test_step(self, action):
+        return self._autoreset(*self.env.test_step(action))
+
+    def post_step(self, action):
+        # simulate_multi updates the curriculum between stepping and starting
+        # the next episode, so it resets post_step envs itself afterwards
+        return self._autoreset(*self.env.post_step(action), reset=False)
+
+    def _autoreset(self, obs, reward, done, info, reset=True):
+        # reset inside the worker so the next episode's first obs comes back
+        # with the terminal step instead of costing another round-trip
+        if done:
+            info["terminated"] = True
+            info["terminal_obs"] = obs
+            info["terminal_id"] = getattr(self.env, "id", None)
+            if reset:
+                obs = self.env.reset()
+                info["reset_id"] = getattr(self.env, "id", None)
+        return obs, reward, done, info
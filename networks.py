@@ -68,14 +68,14 @@ class RSSM(nn.Module):
             if i == 0:
                 inp_dim = self._hidden
         self._inp_layers = nn.Sequential(*inp_layers)
-        self._inp_layers.apply(tools.weight_init)
+        tools.init_weights(self._inp_layers)
 
         if cell == "gru":
             self._cell = GRUCell(self._hidden, self._deter)
-            self._cell.apply(tools.weight_init)
+            tools.init_weights(self._cell)
         elif cell == "gru_layer_norm":
             self._cell = GRUCell(self._hidden, self._deter, norm=True)
-            self._cell.apply(tools.weight_init)
+            tools.init_weights(self._cell)
         else:
             raise NotImplementedError(cell)
 
@@ -88,7 +88,7 @@ class RSSM(nn.Module):
             if i == 0:
                 inp_dim = self._hidden
         self._img_out_layers = nn.Sequential(*img_out_layers)
-        self._img_out_layers.apply(tools.weight_init)
+        tools.init_weights(self._img_out_layers)
 
         obs_out_layers = []
         if self._temp_post:
@@ -102,18 +102,18 @@ class RSSM(nn.Module):
             if i == 0:
                 inp_dim = self._hidden
         self._obs_out_layers = nn.Sequential(*obs_out_layers)
-        self._obs_out_layers.apply(tools.weight_init)
+        tools.init_weights(self._obs_out_layers)
 
         if self._discrete:
             self._ims_stat_layer = nn.Linear(self._hidden, self._stoch * self._discrete)
-            self._ims_stat_layer.apply(tools.weight_init)
+            tools.init_weights(self._ims_stat_layer)
             self._obs_stat_layer = nn.Linear(self._hidden, self._stoch * self._discrete)
-            self._obs_stat_layer.apply(tools.weight_init)
+            tools.init_weights(self._obs_stat_layer)
         else:
             self._ims_stat_layer = nn.Linear(self._hidden, 2 * self._stoch)
-            self._ims_stat_layer.apply(tools.weight_init)
+            tools.init_weights(self._ims_stat_layer)
             self._obs_stat_layer = nn.Linear(self._hidden, 2 * self._stoch)
-            self._obs_stat_layer.apply(tools.weight_init)
+            tools.init_weights(self._obs_stat_layer)
 
         if self._initial == "learned":
             self.W = torch.nn.Parameter(
@@ -206,7 +206,11 @@ class RSSM(nn.Module):
         # otherwise, post use different network(_obs_out_layers) with prior[deter] and embed as inputs
         prev_action *= (1.0 / torch.clip(torch.abs(prev_action), min=1.0)).detach()
         #prev_action = prev_action.squeeze()
-        if torch.sum(is_first) > 0:
+        # graph replay is only used on steps without resets, so the branch can
+        # be skipped (and its host sync avoided) while capturing. Only ask for
+        # cuda tensors, the query raises on cpu-only builds.
+        capturing = is_first.is_cuda and torch.cuda.is_current_stream_capturing()
+        if not capturing and torch.sum(is_first) > 0:
             is_first = is_first[:, None]
       
             prev_action *= 1.0 - is_first
@@ -517,7 +521,7 @@ class ConvEncoder(nn.Module):
 
         self.outdim = out_dim * h * w
         self.layers = nn.Sequential(*layers)
-        self.layers.apply(tools.weight_init)
+        tools.init_weights(self.layers)
 
     def forward(self, obs):
         # (batch, time, h, w, ch) -> (batch * time, h, w, ch)
@@ -554,7 +558,7 @@ class ConvDecoder(nn.Module):
         self._embed_size = minres**2 * depth * 2 ** (layer_num - 1)
 
         self._linear_layer = nn.Linear(feat_size, self._embed_size)
-        self._linear_layer.apply(tools.weight_init)
+        tools.init_weights(self._linear_layer)
         in_dim = self._embed_size // (minres**2)
 
         layers = []
@@ -653,7 +657,7 @@ class MLP(nn.Module):
             if index == 0:
                 inp_dim = units
         self.layers = nn.Sequential(*layers)
-        self.layers.apply(tools.weight_init)
+        tools.init_weights(self.layers)
 
         if isinstance(self._shape, dict):
             self.mean_layer = nn.ModuleDict()
@@ -761,7 +765,7 @@ class ActionHead(nn.Module):
             if index == 0:
                 inp_dim = self._units
         self._pre_layers = nn.Sequential(*pre_layers)
-        self._pre_layers.apply(tools.weight_init)
+        tools.init_weights(self._pre_layers)
 
         if self._dist in ["tanh_normal", "tanh_normal_5", "normal", "trunc_normal"]:
             self._dist_layer = nn.Linear(self._units, 2 * self._size)
@@ -6,6 +6,8 @@ import traceback
 import enum
 from functools import partial as bind
 
+import numpy as np
+
 
 class Parallel:
     def __init__(self, ctor, strategy):
@@ -121,7 +123,20 @@ class ProcessPipeWorker:
         callid = self._nextid
         self._nextid += 1
         self._pipe.send((message, callid, payload))
-        return Future(self._receive, callid)
+        return Future(self._receive, callid, self._poll)
+
+    def _poll(self, callid):
+        # Drain every message that already arrived without blocking.
+        while callid not in self._results and self._pipe.poll():
+            try:
+                message, other, payload = self._pipe.recv()
+            except (OSError, EOFError):
+                raise RuntimeError("Lost connection to worker.")
+            if message == Message.ERROR:
+                raise Exception(payload)
+            assert message == Message.RESULT, message
+            self._results[other] = payload
+        return callid in self._results
 
     def _receive(self, callid):
         while callid not in self._results:
@@ -182,9 +197,10 @@ class Message(enum.Enum):
 
 
 class Future:
-    def __init__(self, receive, callid):
+    def __init__(self, receive, callid, poll=None):
         self._receive = receive
         self._callid = callid
+        self._poll = poll
         self._result = None
         self._complete = False
 
@@ -194,6 +210,11 @@ class Future:
             self._complete = True
         return self._result
 
+    def ready(self):
+        if self._complete or self._poll is None:
+            return True
+        return self._poll(self._callid)
+
 
 class Damy:
     def __init__(self, env):
@@ -220,3 +241,138 @@ class Damy:
 
     def reset(self):
         return lambda: self._env.reset()
+
+
+class AsyncVecEnv:
+    """Send/recv interface over a list of Parallel or Damy envs.
+
+    Actions are dispatched to all workers before any result is awaited, so a
+    batch of process envs takes max(t_i) instead of sum(t_i). With a
+    batch_size below the number of envs, recv() returns as soon as that many
+    envs have finished their step. ids holds the current episode id of every
+    env and follows resets done inside the workers; envs that are not wrapped
+    in AutoReset are reset here when they finish. Observations come back as
+    one preallocated array per key that is overwritten by the next recv().
+    """
+
+    def __init__(self, envs, batch_size=None):
+        self._envs = list(envs)
+        self._batch_size = batch_size or len(self._envs)
+        self._pending = {}
+        self._obs_buf = None
+        self._obs_items = ()
+        self.ids = [env.id for env in self._envs]
+
+    def __len__(self):
+        return len(self._envs)
+
+    def send(self, actions, env_ids=None, method="step"):
+        if env_ids is None:
+            env_ids = range(len(self._envs))
+        actions = _unbatch(actions, len(env_ids))
+        for index, action in zip(env_ids, actions):
+            assert index not in self._pending, index
+            promise = getattr(self._envs[index], method)(action)
+            self._pending[index] = (promise, method)
+
+    def recv(self):
+        count = min(self._batch_size, len(self._pending))
+        if count == len(self._pending):
+            env_ids = sorted(self._pending)
+        else:
+            env_ids = []
+            while len(env_ids) < count:
+                env_ids = [i for i, (p, _) in self._pending.items() if _ready(p)]
+                if len(env_ids) < count:
+                    time.sleep(0.0001)
+            env_ids = sorted(env_ids[:count])
+        reward = np.empty(len(env_ids), np.float32)
+        done = np.empty(len(env_ids), bool)
+        infos = [None] * len(env_ids)
+        for row, index in enumerate(env_ids):
+            promise, method = self._pending.pop(index)
+            obs, reward[row], done[row], infos[row] = _resolve(promise)
+            if done[row] and "terminated" not in infos[row]:
+                obs = self._autoreset(index, obs, infos[row], method)
+            if "terminal_obs" in infos[row]:
+                # the caller patches the terminal obs into the buffers
+                self._add_keys(infos[row]["terminal_obs"])
+            self._write_obs(index, obs)
+            # envs wrapped in AutoReset already started their next episode
+            if "reset_id" in infos[row]:
+                self.ids[index] = infos[row]["reset_id"]
+        return self._obs_buf, reward, done, infos, env_ids
+
+    def _autoreset(self, index, obs, info, method):
+        # Same contract as wrappers.AutoReset for envs without the wrapper,
+        # at the cost of one more round-trip per finished episode. post_step
+        # envs are left for the caller to reset, like AutoReset does.
+        info["terminated"] = True
+        info["terminal_obs"] = obs
+        info["terminal_id"] = self.ids[index]
+        if method == "post_step":
+            return obs
+        obs = _resolve(self._envs[index].reset())
+        info["reset_id"] = self._envs[index].id
+        return obs
+
+    def reset(self, env_ids=None):
+        if env_ids is None:
+            env_ids = range(len(self._envs))
+        promises = [(i, self._envs[i].reset()) for i in env_ids]
+        for index, promise in promises:
+            self._write_obs(index, _resolve(promise))
+            self.ids[index] = self._envs[index].id
+        return self._obs_buf
+
+    def _write_obs(self, index, obs):
+        # One (num_envs, *shape) array per key, allocated when the key first
+        # shows up and overwritten in place afterwards instead of np.stack
+        # every step.
+        self._add_keys(obs)
+        for key, buf in self._obs_items:
+            # keys like log_reward only come with steps, not with resets
+            value = obs.get(key)
+            buf[index] = 0 if value is None else value
+
+    def _add_keys(self, obs):
+        # Rows of envs that have not produced a key yet stay zero, like the
+        # zeros_like backfill of missing keys in the cache.
+        if self._obs_buf is None:
+            self._obs_buf = {}
+        elif self._obs_buf.keys() >= obs.keys():
+            return
+        for key, value in obs.items():
+            if key not in self._obs_buf:
+                value = np.asarray(value)
+                shape = (len(self._envs),) + value.shape
+                self._obs_buf[key] = np.zeros(shape, value.dtype)
+        self._obs_items = tuple(self._obs_buf.items())
+
+    def call(self, name, *args):
+        # Every positional argument holds one entry per env, either as a
+        # sequence or as a dict of batched arrays.
+        args = [_unbatch(arg, len(self._envs)) for arg in args]
+        if args:
+            promises = [
+                getattr(env, name)(*arg) for env, arg in zip(self._envs, zip(*args))
+            ]
+        else:
+            promises = [getattr(env, name)() for env in self._envs]
+        return [_resolve(promise) for promise in promises]
+
+
+def _unbatch(value, count):
+    if isinstance(value, dict):
+        return [{k: v[i] for k, v in value.items()} for i in range(count)]
+    return value
+
+
+def _ready(promise):
+    ready = getattr(promise, "ready", None)
+    return ready() if ready else True
+
+
+def _resolve(promise):
+    # Parallel returns futures, Damy returns lambdas or plain values.
+    return promise() if callable(promise) else promise
@@ -0,0 +1,81 @@
+import pathlib
+import sys
+
+import numpy as np
+
+sys.path.append(str(pathlib.Path(__file__).parent.parent))
+
+from parallel import AsyncVecEnv, Damy
+
+
+class StepOnlyKeyEnv:
+    # like Crafter, reset obs lack the log_ keys that every step returns
+    def __init__(self, length):
+        self._length = length
+        self._step = 0
+        self.id = None
+
+    def reset(self):
+        self._step = 0
+        self.id = f"episode-{id(self)}-{np.random.randint(1 << 30)}"
+        return {"image": np.zeros((2, 2, 3), np.uint8), "is_first": True}
+
+    def step(self, action):
+        self._step += 1
+        obs = {
+            "image": np.full((2, 2, 3), self._step, np.uint8),
+            "is_first": False,
+            "log_reward": np.float32(self._step),
+        }
+        return obs, 1.0, self._step >= self._length, {}
+
+
+def test_step_only_key():
+    vec = AsyncVecEnv([Damy(StepOnlyKeyEnv(1)), Damy(StepOnlyKeyEnv(3))])
+    obs = vec.reset()
+    assert "log_reward" not in obs
+    vec.send(np.zeros((2, 1)))
+    obs, reward, done, infos, _ = vec.recv()
+    assert done.tolist() == [True, False]
+    # env 0 finished on its first step and was reset, its row stays zero
+    assert obs["log_reward"].tolist() == [0.0, 1.0]
+    assert infos[0]["terminal_obs"]["log_reward"] == 1.0
+    vec.send(np.zeros((2, 1)))
+    obs, reward, done, infos, _ = vec.recv()
+    assert obs["log_reward"].tolist() == [0.0, 2.0]
+    assert obs["image"][1].max() == 2
+
+
+class _Logger:
+    def __init__(self):
+        self.step = 0
+        self.scalars = {}
+
+    def scalar(self, name, value):
+        self.scalars[name] = value
+
+    def write(self, step=False):
+        pass
+
+    def video(self, name, value):
+        pass
+
+
+def test_simulate_step_only_key(tmp_path):
+    import collections
+
+    import pytest
+
+    pytest.importorskip("torch")
+    import tools
+
+    envs = [Damy(StepOnlyKeyEnv(1)), Damy(StepOnlyKeyEnv(3))]
+    agent = lambda obs, done, state: ({"action": np.zeros((len(done), 1))}, state)
+    cache = collections.OrderedDict()
+    logger = _Logger()
+    tools.simulate(agent, envs, cache, tmp_path, logger, limit=100, episodes=3)
+    tools.flush_episodes()
+    # the log_ keys reached the cache and were logged at the episode ends,
+    # the last one is the 3 step episode of the second env
+    assert logger.scalars["log_reward"] == 6.0
+    assert all(len(ep["image"]) == len(ep["reward"]) for ep in cache.values())
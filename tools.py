@@ -1,10 +1,15 @@
 import datetime
 import collections
-import io
+import concurrent.futures
+import functools
+import itertools
 import os
 import json
+import math
 import pathlib
+import queue
 import re
+import threading
 import time
 import random
 
@@ -16,16 +21,59 @@ from torch.nn import functional as F
 from torch import distributions as torchd
 from torch.utils.tensorboard import SummaryWriter
 
+from parallel import AsyncVecEnv
+
+
+def to_np(x, out=None):
+    # with a pinned out buffer the copy is asynchronous, the result may only
+    # be read after synchronizing the current stream
+    x = x.detach()
+    if out is None or not x.is_cuda:
+        return x.cpu().numpy()
+    out.copy_(x, non_blocking=True)
+    return out.numpy()
+
+
+def _to_host(tensors, staging):
+    # one pinned staging buffer per key, reused across steps, so the returned
+    # arrays are overwritten by the next call
+    arrays = {}
+    for key, value in tensors.items():
+        buf = staging.get(key)
+        stale = buf is None or buf.shape != value.shape or buf.dtype != value.dtype
+        if value.is_cuda and stale:
+            buf = staging[key] = torch.empty(
+                value.shape, dtype=value.dtype, pin_memory=True
+            )
+        arrays[key] = to_np(value, buf)
+    if any(value.is_cuda for value in tensors.values()):
+        torch.cuda.current_stream().synchronize()
+    return arrays
+
+
+def _host_action(action, staging, count, is_dict):
+    # one device to host copy per key, rows are split at the workers
+    if is_dict:
+        action = _to_host(action, staging)
+        assert all(len(v) == count for v in action.values())
+    else:
+        action = np.array(action)
+        assert len(action) == count
+    return action
 
-to_np = lambda x: x.detach().cpu().numpy()
+# per-step diagnostics of the simulate loops, off unless set in the environment
+_DEBUG = bool(os.environ.get("DREAMER_DEBUG"))
+_PROFILE = bool(os.environ.get("DV3_PROFILE"))
 
 
-def symlog(x):
-    return torch.sign(x) * torch.log(torch.abs(x) + 1.0)
+@torch.jit.script
+def symlog(x: torch.Tensor) -> torch.Tensor:
+    return torch.sign(x) * torch.log1p(torch.abs(x))
 
 
-def symexp(x):
-    return torch.sign(x) * (torch.exp(torch.abs(x)) - 1.0)
+@torch.jit.script
+def symexp(x: torch.Tensor) -> torch.Tensor:
+    return torch.sign(x) * torch.expm1(torch.abs(x))
 
 
 class RequiresGrad:
@@ -40,29 +88,55 @@ class RequiresGrad:
 
 
 class TimeRecording:
+    # recorded events are only resolved in flush(), behind a single sync
+    _records = []
+
     def __init__(self, comment):
         self._comment = comment
+        self._enabled = _PROFILE
 
     def __enter__(self):
+        if not self._enabled:
+            return
         self._st = torch.cuda.Event(enable_timing=True)
         self._nd = torch.cuda.Event(enable_timing=True)
         self._st.record()
 
     def __exit__(self, *args):
+        if not self._enabled:
+            return
         self._nd.record()
+        TimeRecording._records.append((self._st, self._nd, self._comment))
+
+    @classmethod
+    def flush(cls):
+        if not cls._records:
+            return
         torch.cuda.synchronize()
-        print(self._comment, self._st.elapsed_time(self._nd) / 1000)
+        for st, nd, comment in cls._records:
+            print(comment, st.elapsed_time(nd) / 1000)
+        cls._records = []
 
 
 class Logger:
-    def __init__(self, logdir, step):
+    def __init__(self, logdir, step, flush_every=10):
         self._logdir = logdir
         self._writer = SummaryWriter(log_dir=str(logdir), max_queue=1000)
+        # kept open for the whole run, line buffered so every write lands
+        self._jsonl = (logdir / "metrics.jsonl").open("a", buffering=1)
+        self._flush_every = flush_every
+        self._writes = 0
+        # flushing happens off the training thread, requests beyond the bound
+        # are dropped since one pending flush covers them
+        self._flush_queue = queue.Queue(maxsize=8)
+        self._flusher = threading.Thread(target=self._flush_loop, daemon=True)
+        self._flusher.start()
         self._last_step = None
         self._last_time = None
         self._scalars = {}
         self._images = {}
         self._videos = {}
+        self._video_buf = None
         self.step = step
 
     def scalar(self, name, value):
@@ -77,32 +151,49 @@ class Logger:
     def write(self, fps=False, step=False):
         if not step:
             step = self.step
-        scalars = list(self._scalars.items())
         if fps:
-            scalars.append(("fps", self._compute_fps(step)))
-        print(f"[{step}]", " / ".join(f"{k} {v:.4f}" for k, v in scalars))
-        with (self._logdir / "metrics.jsonl").open("a") as f:
-            f.write(json.dumps({"step": step, **dict(scalars)}) + "\n")
-        for name, value in scalars:
+            self._scalars["fps"] = self._compute_fps(step)
+        # one pass builds the console line and the jsonl record and hands
+        # every scalar to the writer
+        line, record = [], {"step": step}
+        for name, value in self._scalars.items():
+            line.append(f"{name} {value:.4f}")
+            record[name] = value
             if "/" not in name:
                 self._writer.add_scalar("scalars/" + name, value, step)
             else:
                 self._writer.add_scalar(name, value, step)
+        print(f"[{step}]", " / ".join(line))
+        self._jsonl.write(json.dumps(record) + "\n")
         for name, value in self._images.items():
             self._writer.add_image(name, value, step)
         for name, value in self._videos.items():
             name = name if isinstance(name, str) else name.decode("utf-8")
-            if np.issubdtype(value.dtype, np.floating):
-                value = np.clip(255 * value, 0, 255).astype(np.uint8)
-            B, T, H, W, C = value.shape
-            value = value.transpose(1, 4, 2, 0, 3).reshape((1, T, C, H, B * W))
-            self._writer.add_video(name, value, step, 16)
+            self._writer.add_video(name, self._pack_video(value), step, 16)
 
-        self._writer.flush()
+        self._writes += 1
+        if self._videos:
+            self._writer.flush()
+        elif fps or self._writes % self._flush_every == 0:
+            try:
+                self._flush_queue.put_nowait(True)
+            except queue.Full:
+                pass
+        TimeRecording.flush()
         self._scalars = {}
         self._images = {}
         self._videos = {}
 
+    def close(self):
+        self._flush_queue.put(None)
+        self._flusher.join()
+        self._writer.close()
+        self._jsonl.close()
+
+    def _flush_loop(self):
+        while self._flush_queue.get() is not None:
+            self._writer.flush()
+
     def _compute_fps(self, step):
         if self._last_step is None:
             self._last_time = time.time()
@@ -118,11 +209,92 @@ class Logger:
         self._writer.add_scalar("scalars/" + name, value, step)
 
     def offline_video(self, name, value, step):
+        self._writer.add_video(name, self._pack_video(value), step, 16)
+
+    def _pack_video(self, value):
+        # (B, T, H, W, C) -> (1, T, C, H, B * W). The transpose moves W next
+        # to B, so the reshape can never be a view; write the transposed view
+        # straight into a reused contiguous buffer instead of copying twice.
         if np.issubdtype(value.dtype, np.floating):
             value = np.clip(255 * value, 0, 255).astype(np.uint8)
         B, T, H, W, C = value.shape
-        value = value.transpose(1, 4, 2, 0, 3).reshape((1, T, C, H, B * W))
-        self._writer.add_video(name, value, step, 16)
+        shape = (1, T, C, H, B * W)
+        out = self._video_buf
+        if out is None or out.shape != shape or out.dtype != value.dtype:
+            out = self._video_buf = np.empty(shape, value.dtype)
+        np.copyto(out.reshape((T, C, H, B, W)), value.transpose(1, 4, 2, 0, 3))
+        return out
+
+# curriculum learning in simulate_multi
+_CURRI_REWARD_THRESHOLD = 6  # this depends massively on rewards
+_CURRI_MIN_EPISODES = 5
+# columns of get_curriculum_values() and set_curriculum_values()
+(
+    _CURRI_MAP_SIZE,
+    _CURRI_RANDOM_ORIENTATION,
+    _CURRI_NUM_OBSTACLES,
+    _CURRI_MIN_DIST,
+    _CURRI_EPISODE_LENGTH,
+    _CURRI_REWARD_FIRST_TIME,
+) = range(6)
+# columns that are stepped towards their limits, with their increments and
+# the env attributes holding the limits
+_CURRI_STEPPED = [
+    _CURRI_MAP_SIZE,
+    _CURRI_NUM_OBSTACLES,
+    _CURRI_MIN_DIST,
+    _CURRI_EPISODE_LENGTH,
+]
+_CURRI_INC = np.array([2, 1, 0.5, 75], dtype=np.float64)
+_CURRI_LIMITS = (
+    "map_limit",
+    "num_obstacles_limit",
+    "distance_between_objects_limit",
+    "max_length",
+)
+
+
+def _get_curriculum_batch(vec):
+    # (num_envs, num_columns) array with bools as 0/1, and the python type of
+    # every column so values can be given back as the env handed them out
+    rows = vec.call("get_curriculum_values")
+    types = [type(value) for value in rows[0]]
+    return np.array(rows, dtype=np.float64), types
+
+
+def _set_curriculum_batch(vec, values, types):
+    rows = [
+        [_curriculum_value(value, kind) for value, kind in zip(row, types)]
+        for row in values.tolist()
+    ]
+    return vec.call("set_curriculum_values", *zip(*rows))
+
+
+def _curriculum_limits(envs):
+    return np.array(
+        [[getattr(env, name) for name in _CURRI_LIMITS] for env in envs],
+        dtype=np.float64,
+    )
+
+
+def _curriculum_coords_check(vec, types, num_objects, min_dist, map_size):
+    columns = (_CURRI_NUM_OBSTACLES, _CURRI_MIN_DIST, _CURRI_MAP_SIZE)
+    args = [
+        [_curriculum_value(value, types[column]) for value in values]
+        for column, values in zip(columns, (num_objects, min_dist, map_size))
+    ]
+    return np.array(vec.call("curriculum_coords_check", *args), dtype=bool)
+
+
+def _curriculum_value(value, kind):
+    if issubclass(kind, (bool, np.bool_)):
+        return bool(value)
+    # an int column only turns float once a fractional increment was added,
+    # as it would with python arithmetic on the env's values
+    if issubclass(kind, (int, np.integer)) and float(value).is_integer():
+        return int(value)
+    return float(value)
+
 
 def run_agent(
     agent,
@@ -139,70 +311,38 @@ def run_agent(
 ):
     print(" ---- running agent")
     time_elapsed = None
+    vec = AsyncVecEnv(envs)
+    staging = {}
+    action_is_dict = None
     # initialize or unpack simulation state
     if state is None:
         step, episode = 0, 0
         done = np.ones(len(envs), bool)
         length = np.zeros(len(envs), np.int32)
-        obs = [None] * len(envs)
+        obs = vec.reset()
         agent_state = None
         reward = [0] * len(envs)
     else:
         step, episode, done, length, obs, agent_state, reward = state
-    while True:#(steps and step < steps) or (episodes and episode < episodes):
-        # print("=======")
-        # start_time = time.time()
-
-        # print(f"Simulation, episodes {episodes}, {step}/{steps} steps. Length: {length}")
+    while (steps and step < steps) or (episodes and episode < episodes):
         # reset envs if necessary
-        # print("should we reset", done.any())
         if done.any():
-            indices = [index for index, d in enumerate(done) if d]
-            results = [envs[i].reset() for i in indices]
-            results = [r() for r in results]
-            for index, result in zip(indices, results):
-                t = result.copy()
-                t = {k: convert(v) for k, v in t.items()}
-                # action will be added to transition in add_to_cache
-                t["reward"] = 0.0
-                t["discount"] = 1.0
-                # initial state should be added to cache
-                add_to_cache(cache, envs[index].id, t)
-                # replace obs with done by initial state
-                obs[index] = result
+            # envs reset themselves, obs already holds the initial state
+            _cache_initial(cache, vec, obs, done)
 
-        # print("reset time ", time.time()-start_time)
-        # start_time2 = time.time()
         # step agents
-        obs = {k: np.stack([o[k] for o in obs]) for k in obs[0]}
         action, agent_state = agent(obs, done, agent_state, training=False)
-        # print(action, agent_state)
-        agent_dist_target = obs["dist_to_target"][0]
-        print(agent_dist_target)
-        if isinstance(action, dict):
-            action = [
-                {k: np.array(action[k][i].detach().cpu()) for k in action}
-                for i in range(len(envs))
-            ]
-        else:
-            action = np.array(action)
-        assert len(action) == len(envs)
-
-        results = [e.test_step(a) for e, a in zip(envs, action)]
-        results = [r() for r in results]
-        # print(results)
-
-        obs, reward, done = zip(*[p[:3] for p in results])
-        obs = list(obs)
-        reward = list(reward)
-        done = np.stack(done)
-        episode += int(done.sum())
-        length += 1
+        if action_is_dict is None:
+            # the policy output type does not change between steps
+            action_is_dict = isinstance(action, dict)
+        action = _host_action(action, staging, len(envs), action_is_dict)
+
+        vec.send(action, method="test_step")
+        obs, reward, done, infos, _ = vec.recv()
+        finished, indices = _step_bookkeeping(done, length)
+        episode += finished
         step += len(envs)
-        length *= 1 - done
 
-        # print("Time taken for 1 simulation: ", (time.time()-start_time))
-    # print(f"Time elapsed: {time.time() - start_time}")
     if is_eval:
         # keep only last item for saving memory. this cache is used for video_pred later
         while len(cache) > 1:
@@ -224,12 +364,15 @@ def simulate_multi_test(
     state=None,
 ):
     time_elapsed = None
+    vec = AsyncVecEnv(envs)
+    staging = {}
+    action_is_dict = None
     # initialize or unpack simulation state
     if state is None:
         step, episode = 0, 0
         done = np.ones(len(envs), bool)
         length = np.zeros(len(envs), np.int32)
-        obs = [None] * len(envs)
+        obs = vec.reset()
         agent_state = None
         reward = [0] * len(envs)
     else:
@@ -242,33 +385,17 @@ def simulate_multi_test(
         # print(f"Simulation, episodes {episodes}, {step}/{steps} steps. Length: {length}")
         # reset envs if necessary
         if done.any():
-            indices = [index for index, d in enumerate(done) if d]
-            results = [envs[i].reset() for i in indices]
-            results = [r() for r in results]
-            for index, result in zip(indices, results):
-                t = result.copy()
-                t = {k: convert(v) for k, v in t.items()}
-                # action will be added to transition in add_to_cache
-                t["reward"] = 0.0
-                t["discount"] = 1.0
-                # initial state should be added to cache
-                add_to_cache(cache, envs[index].id, t)
-                # replace obs with done by initial state
-                obs[index] = result
+            # envs reset themselves, obs already holds the initial state
+            _cache_initial(cache, vec, obs, done)
 
         # print("reset time ", time.time()-start_time)
         # start_time2 = time.time()
         # step agents
-        obs = {k: np.stack([o[k] for o in obs]) for k in obs[0]}
         action, agent_state = agent(obs, done, agent_state, training=False)
-        if isinstance(action, dict):
-            action = [
-                {k: np.array(action[k][i].detach().cpu()) for k in action}
-                for i in range(len(envs))
-            ]
-        else:
-            action = np.array(action)
-        assert len(action) == len(envs)
+        if action_is_dict is None:
+            # the policy output type does not change between steps
+            action_is_dict = isinstance(action, dict)
+        action = _host_action(action, staging, len(envs), action_is_dict)
         # step envs
         # pre_steps = [e.pre_step(a) for e, a in zip(envs, action)]
         # pre_steps= [r() for r in pre_steps]
@@ -277,31 +404,18 @@ def simulate_multi_test(
         # # run = run()
 
         # perform rest of actual step
-        results = [e.test_step(a) for e, a in zip(envs, action)]
-        results = [r() for r in results]
-
-        obs, reward, done = zip(*[p[:3] for p in results])
-        obs = list(obs)
-        reward = list(reward)
-        done = np.stack(done)
-        episode += int(done.sum())
-        length += 1
+        vec.send(action, method="test_step")
+        obs, reward, done, infos, _ = vec.recv()
+        finished, indices = _step_bookkeeping(done, length)
+        episode += finished
         step += len(envs)
-        length *= 1 - done
 
         # print("step actions and increament lengths", time.time()-start_time2)
         # add to cache
-        for a, result, env in zip(action, results, envs):
-            o, r, d, info = result
-            o = {k: convert(v) for k, v in o.items()}
-            transition = o.copy()
-            if isinstance(a, dict):
-                transition.update(a)
-            else:
-                transition["action"] = a
-            transition["reward"] = r
-            transition["discount"] = info.get("discount", np.array(1 - float(d)))
-            add_to_cache(cache, env.id, transition)
+        ids = [info.get("terminal_id", id) for info, id in zip(infos, vec.ids)]
+        add_to_cache_batched(
+            cache, ids, *_step_transitions(obs, action, reward, done, infos)
+        )
 
         # if done.any():
         #     if start_time is not None:
@@ -377,204 +491,133 @@ def simulate_multi(
     time_elapsed = None
     curriculum_learning = True
     if curriculum_learning:
-        reward_threshold = 6 # this depends massively on rewards
-        min_episodes_threshold = 5
         total_reward = 0
-        map_size_increase = 2
-        num_obstacles_increase = 1
-        min_dist_between_objs_increase = 0.5
-        episode_length_increase = 75
-        dist_between_inter_and_goal_increase = 2
-        dist_between_inter_and_agent_increase = 2
     # episode_counter = [0] * len(envs)
     episode_counter = 0
+    # env limits of the stepped curriculum columns, read on the first update
+    curriculum_limits = None
+    vec = AsyncVecEnv(envs)
+    staging = {}
+    action_is_dict = None
     # initialize or unpack simulation state
     if state is None:
         step, episode = 0, 0
         done = np.ones(len(envs), bool)
         length = np.zeros(len(envs), np.int32)
-        obs = [None] * len(envs)
+        obs = vec.reset()
         agent_state = None
         reward = [0] * len(envs)
+        returns = np.zeros(len(envs), np.float64)
     else:
         step, episode, done, length, obs, agent_state, reward = state
+        returns = _running_returns(cache, vec.ids, done)
         # total_reward = sum(reward)
     while (steps and step < steps) or (episodes and episode < episodes):
         # print("EPISODES: ",episodes, "EPISODE: ", episode)
         # reset envs if necessary
         if done.any():
-            indices = [index for index, d in enumerate(done) if d]
-            results = [envs[i].reset() for i in indices]
-            results = [r() for r in results]
-
-            for index, result in zip(indices, results):
-                t = result.copy()
-                t = {k: convert(v) for k, v in t.items()}
-                # action will be added to transition in add_to_cache
-                t["reward"] = 0.0
-                t["discount"] = 1.0
-                # initial state should be added to cache
-                add_to_cache(cache, envs[index].id, t)
-                # replace obs with done by initial state
-                obs[index] = result
+            # post_step envs were reset by vec.reset after the curriculum
+            # update, obs already holds the initial state
+            indices = _cache_initial(cache, vec, obs, done)
+            returns[indices] = 0.0
 
         # step agents
-        obs = {k: np.stack([o[k] for o in obs]) for k in obs[0]}
         action, agent_state = agent(obs, done, agent_state)
-        if isinstance(action, dict):
-            action = [
-                {k: np.array(action[k][i].detach().cpu()) for k in action}
-                for i in range(len(envs))
-            ]
-        else:
-            action = np.array(action)
-        assert len(action) == len(envs)
+        if action_is_dict is None:
+            # the policy output type does not change between steps
+            action_is_dict = isinstance(action, dict)
+        action = _host_action(action, staging, len(envs), action_is_dict)
         # step envs
-        pre_steps = [e.pre_step(a) for e, a in zip(envs, action)]
-        pre_steps= [r() for r in pre_steps]
+        vec.call("pre_step", action)
         # run sim for all
         run = envs[0].simulate_steps()
         # run = run()
 
         # perform rest of actual step
-        results = [e.post_step(a) for e, a in zip(envs, action)]
-        results = [r() for r in results]
-
-        obs, reward, done = zip(*[p[:3] for p in results])
+        vec.send(action, method="post_step")
+        obs, reward, done, infos, _ = vec.recv()
+        # running episode return, read at done instead of summing the cache
+        returns += reward
         if curriculum_learning:
             total_reward += sum(reward)
             average_reward = total_reward / episode_counter if episode_counter != 0 else 0
         # if average_reward:
         #     print("average_reward", average_reward)
-        obs = list(obs)
-        reward = list(reward)
-        done = np.stack(done)
-        episode += int(done.sum())
-        episode_counter += int(done.sum())
-        length += 1
+        finished, indices = _step_bookkeeping(done, length)
+        episode += finished
+        episode_counter += finished
         step += len(envs)
-        length *= 1 - done
 
         if curriculum_learning:
             # If the condition for increasing difficulty is met
             # print(average_reward)
             # print(envs[0].get_curriculum_values())
-            if episode_counter >= min_episodes_threshold and average_reward > reward_threshold:
-                print("god help us")
-                print("map limit", envs[0].map_limit)
-                # Increase difficulty for all environments
-                for i in range(len(envs)):
-                    (size_of_map, 
-                    random_starting_orientation, 
-                    num_obstacles, 
-                    min_dist_between_objs,
-                    episode_length,
-                    reward_first_time) = envs[i].get_curriculum_values()
-                    # min_dist_between_inter_and_goal, 
-                    # max_dist_between_inter_and_goal, 
-                    # min_dist_between_inter_and_agent, 
-                    # max_dist_between_inter_and_agent) 
-                    if size_of_map < envs[i].map_limit:
-                        new_map_size = size_of_map+map_size_increase
-                        new_map_size = min(new_map_size, envs[i].map_limit)
-                    else:
-                        new_map_size = size_of_map
-                    if num_obstacles < envs[i].num_obstacles_limit:
-                        new_num_obstacles = num_obstacles+num_obstacles_increase
-                        new_num_obstacles = min(new_num_obstacles, envs[i].num_obstacles_limit)
-                    else:
-                        new_num_obstacles = num_obstacles
-                    if min_dist_between_objs < envs[i].distance_between_objects_limit:
-                        new_min_dist_between_objs = min_dist_between_objs+min_dist_between_objs_increase
-                        new_min_dist_between_objs = min(new_min_dist_between_objs, envs[i].distance_between_objects_limit)
-                    else:
-                        new_min_dist_between_objs = min_dist_between_objs
-                    if episode_length < envs[i].max_length:
-                        new_episode_length = episode_length+episode_length_increase
-                        new_episode_length = min(new_episode_length, envs[i].max_length)
-                    if episode_counter > 20:
-                        reward_first_time = False
-
-                    # if min_dist_between_inter_and_goal < envs[i].min_dist_between_inter_and_goal_limit:
-                    #     new_min_dist_between_inter_and_goal = min_dist_between_inter_and_goal+dist_between_inter_and_goal_increase
-                    #     new_min_dist_between_inter_and_goal = min(new_min_dist_between_inter_and_goal, envs[i].min_dist_between_inter_and_goal_limit)
-                    # else:
-                    #     new_min_dist_between_inter_and_goal = min_dist_between_inter_and_goal
-                    # if max_dist_between_inter_and_goal < envs[i].max_dist_between_inter_and_goal_limit:
-                    #     new_max_dist_between_inter_and_goal = max_dist_between_inter_and_goal+dist_between_inter_and_goal_increase
-                    #     new_max_dist_between_inter_and_goal = min(new_max_dist_between_inter_and_goal, envs[i].max_dist_between_inter_and_goal_limit)
-                    # else:
-                    #     new_max_dist_between_inter_and_goal = max_dist_between_inter_and_goal
-                    # if min_dist_between_inter_and_agent < envs[i].min_dist_between_inter_and_agent_limit:
-                    #     new_min_dist_between_inter_and_agent = min_dist_between_inter_and_agent+dist_between_inter_and_agent_increase
-                    #     new_min_dist_between_inter_and_agent = min(new_min_dist_between_inter_and_agent, envs[i].min_dist_between_inter_and_agent_limit)
-                    # else:
-                    #     new_min_dist_between_inter_and_agent = min_dist_between_inter_and_agent
-                    # if max_dist_between_inter_and_agent < envs[i].max_dist_between_inter_and_agent:
-                    #     new_max_dist_between_inter_and_agent = max_dist_between_inter_and_agent+dist_between_inter_and_agent_increase
-                    #     new_max_dist_between_inter_and_agent = min(new_max_dist_between_inter_and_agent, envs[i].max_dist_between_inter_and_agent)
-                    # else:
-                    #     new_max_dist_between_inter_and_agent = max_dist_between_inter_and_agent
-                    if envs[i].curriculum_coords_check(new_num_obstacles+3, new_min_dist_between_objs, new_map_size):
-                        new_map_size+=3
-                        new_map_size = min(new_map_size, envs[i].map_limit)
-                    if new_map_size >= 20: # and new_num_obstacles == envs[i].num_obstacles_limit and new_min_dist_between_objs == envs[i].distance_between_objects_limit:
-                        random_starting_orientation = True
-
-                    envs[i].set_curriculum_values(
-                        new_map_size,
-                        random_starting_orientation,
-                        new_num_obstacles,
-                        new_min_dist_between_objs,
-                        new_episode_length,
-                        reward_first_time
-                        # new_min_dist_between_inter_and_goal,
-                        # new_max_dist_between_inter_and_goal,
-                        # new_min_dist_between_inter_and_agent,
-                        # new_max_dist_between_inter_and_agent
-                    )
-                    print("CURRICULUM PARAMETERS: ", envs[i].get_curriculum_values())
+            if (
+                episode_counter >= _CURRI_MIN_EPISODES
+                and average_reward > _CURRI_REWARD_THRESHOLD
+            ):
+                # Increase difficulty for all environments at once
+                values, types = _get_curriculum_batch(vec)
+                if curriculum_limits is None:
+                    curriculum_limits = _curriculum_limits(envs)
+                limits = curriculum_limits
+                cur = values[:, _CURRI_STEPPED]
+                new = np.where(cur < limits, np.minimum(cur + _CURRI_INC, limits), cur)
+                values[:, _CURRI_STEPPED] = new
+                map_size = values[:, _CURRI_MAP_SIZE]
+                grow = _curriculum_coords_check(
+                    vec,
+                    types,
+                    values[:, _CURRI_NUM_OBSTACLES] + 3,
+                    values[:, _CURRI_MIN_DIST],
+                    map_size,
+                )
+                map_size[grow] = np.minimum(map_size[grow] + 3, limits[grow, 0])
+                values[:, _CURRI_RANDOM_ORIENTATION] = np.logical_or(
+                    values[:, _CURRI_RANDOM_ORIENTATION], map_size >= 20
+                )
+                if episode_counter > 20:
+                    values[:, _CURRI_REWARD_FIRST_TIME] = False
+                _set_curriculum_batch(vec, values, types)
+                print("CURRICULUM PARAMETERS: ", values.tolist())
                 total_reward = 0
                 episode_counter = 0
 
         # add to cache
-        for a, result, env in zip(action, results, envs):
-            o, r, d, info = result
-            o = {k: convert(v) for k, v in o.items()}
-            transition = o.copy()
-            if isinstance(a, dict):
-                transition.update(a)
-            else:
-                transition["action"] = a
-            transition["reward"] = r
-            transition["discount"] = info.get("discount", np.array(1 - float(d)))
-            add_to_cache(cache, env.id, transition)
+        ids = [info.get("terminal_id", id) for info, id in zip(infos, vec.ids)]
+        add_to_cache_batched(
+            cache, ids, *_step_transitions(obs, action, reward, done, infos)
+        )
+        if finished:
+            # post_step envs don't reset themselves, start their next episode
+            # only now so it already uses the updated curriculum
+            vec.reset(indices)
 
-        if done.any():
+        if finished:
             if start_time is not None:
                 a = 1
                 time_elapsed = time.time() - start_time
-            indices = [index for index, d in enumerate(done) if d]
             # logging for done episode 
             for i in indices:
-                save_episodes(directory, {envs[i].id: cache[envs[i].id]})
-                length = len(cache[envs[i].id]["reward"]) - 1
-                score = float(np.array(cache[envs[i].id]["reward"]).sum())
-                video = cache[envs[i].id]["image"]
+                env_id = infos[i]["terminal_id"]
+                _finish_episode(cache, env_id)
+                save_episodes(directory, {env_id: cache[env_id]})
+                ep_length = len(cache[env_id]["reward"]) - 1
+                score = float(returns[i])
                 # record logs given from environments
-                for key in list(cache[envs[i].id].keys()):
+                for key in list(cache[env_id].keys()):
                     if "log_" in key:
                         logger.scalar(
-                            key, float(np.array(cache[envs[i].id][key]).sum())
+                            key, float(np.array(cache[env_id][key]).sum())
                         )
                         # log items won't be used later
-                        cache[envs[i].id].pop(key)
+                        cache[env_id].pop(key)
 
                 if not is_eval:
                     step_in_dataset = erase_over_episodes(cache, limit)
                     logger.scalar(f"dataset_size", step_in_dataset)
                     logger.scalar(f"train_return", score)
-                    logger.scalar(f"train_length", length)
+                    logger.scalar(f"train_length", ep_length)
                     logger.scalar(f"train_episodes", len(cache))
                     if time_elapsed:
                         logger.scalar(f"time elapsed", time_elapsed)
@@ -586,15 +629,15 @@ def simulate_multi(
                         eval_done = False
                     # start counting scores for evaluation
                     eval_scores.append(score)
-                    eval_lengths.append(length)
+                    eval_lengths.append(ep_length)
 
                     score = sum(eval_scores) / len(eval_scores)
-                    length = sum(eval_lengths) / len(eval_lengths)
-                    logger.video(f"eval_policy", np.array(video)[None])
+                    ep_length = sum(eval_lengths) / len(eval_lengths)
+                    logger.video(f"eval_policy", cache[env_id]["image"][None])
 
                     if len(eval_scores) >= episodes and not eval_done:
                         logger.scalar(f"eval_return", score)
-                        logger.scalar(f"eval_length", length)
+                        logger.scalar(f"eval_length", ep_length)
                         logger.scalar(f"eval_episodes", len(eval_scores))
                         logger.write(step=logger.step)
                         eval_done = True
@@ -617,95 +660,77 @@ def simulate(
     episodes=0,
     state=None,
 ):
+    vec = AsyncVecEnv(envs)
+    staging = {}
+    action_is_dict = None
     # initialize or unpack simulation state
     if state is None:
         step, episode = 0, 0
         done = np.ones(len(envs), bool)
         length = np.zeros(len(envs), np.int32)
-        obs = [None] * len(envs)
+        obs = vec.reset()
         agent_state = None
         reward = [0] * len(envs)
+        returns = np.zeros(len(envs), np.float64)
     else:
         step, episode, done, length, obs, agent_state, reward = state
+        returns = _running_returns(cache, vec.ids, done)
     while (steps and step < steps) or (episodes and episode < episodes):
-        print("=======")
-        start_time = time.time()
+        if _PROFILE:
+            start_time = time.time()
         # reset envs if necessary
         if done.any():
-            indices = [index for index, d in enumerate(done) if d]
-            results = [envs[i].reset() for i in indices]
-            results = [r() for r in results]
-            for index, result in zip(indices, results):
-                t = result.copy()
-                t = {k: convert(v) for k, v in t.items()}
-                # action will be added to transition in add_to_cache
-                t["reward"] = 0.0
-                t["discount"] = 1.0
-                # initial state should be added to cache
-                add_to_cache(cache, envs[index].id, t)
-                # replace obs with done by initial state
-                obs[index] = result
-        print("reset time ", time.time()-start_time)
-        start_time2 = time.time()
+            # envs reset themselves, obs already holds the initial state
+            indices = _cache_initial(cache, vec, obs, done)
+            returns[indices] = 0.0
+        if _PROFILE:
+            print("reset time ", time.time() - start_time)
+            start_time2 = time.time()
         # step agents
-        obs = {k: np.stack([o[k] for o in obs]) for k in obs[0]}
         action, agent_state = agent(obs, done, agent_state)
-        if isinstance(action, dict):
-            action = [
-                {k: np.array(action[k][i].detach().cpu()) for k in action}
-                for i in range(len(envs))
-            ]
-        else:
-            action = np.array(action)
-        assert len(action) == len(envs)
+        if action_is_dict is None:
+            # the policy output type does not change between steps
+            action_is_dict = isinstance(action, dict)
+        action = _host_action(action, staging, len(envs), action_is_dict)
 
         # step envs
-        results = [e.step(a) for e, a in zip(envs, action)]
-        results = [r() for r in results]
-        obs, reward, done = zip(*[p[:3] for p in results])
-        obs = list(obs)
-        reward = list(reward)
-        done = np.stack(done)
-        episode += int(done.sum())
-        length += 1
+        vec.send(action)
+        obs, reward, done, infos, _ = vec.recv()
+        # running episode return, read at done instead of summing the cache
+        returns += reward
+        finished, indices = _step_bookkeeping(done, length)
+        episode += finished
         step += len(envs)
-        length *= 1 - done
-        print("step actions and increament lengths", time.time()-start_time2)
+        if _PROFILE:
+            print("step actions and increament lengths", time.time() - start_time2)
         # add to cache
-        for a, result, env in zip(action, results, envs):
-            o, r, d, info = result
-            o = {k: convert(v) for k, v in o.items()}
-            transition = o.copy()
-            if isinstance(a, dict):
-                transition.update(a)
-            else:
-                transition["action"] = a
-            transition["reward"] = r
-            transition["discount"] = info.get("discount", np.array(1 - float(d)))
-            add_to_cache(cache, env.id, transition)
+        ids = [info.get("terminal_id", id) for info, id in zip(infos, vec.ids)]
+        add_to_cache_batched(
+            cache, ids, *_step_transitions(obs, action, reward, done, infos)
+        )
 
-        if done.any():
-            indices = [index for index, d in enumerate(done) if d]
+        if finished:
             # logging for done episode 
             for i in indices:
-                save_episodes(directory, {envs[i].id: cache[envs[i].id]})
-                length = len(cache[envs[i].id]["reward"]) - 1
-                score = float(np.array(cache[envs[i].id]["reward"]).sum())
-                video = cache[envs[i].id]["image"]
+                env_id = infos[i]["terminal_id"]
+                _finish_episode(cache, env_id)
+                save_episodes(directory, {env_id: cache[env_id]})
+                ep_length = len(cache[env_id]["reward"]) - 1
+                score = float(returns[i])
                 # record logs given from environments
-                for key in list(cache[envs[i].id].keys()):
+                for key in list(cache[env_id].keys()):
                     if "log_" in key:
                         logger.scalar(
-                            key, float(np.array(cache[envs[i].id][key]).sum())
+                            key, float(np.array(cache[env_id][key]).sum())
                         )
                         # log items won't be used later
-                        cache[envs[i].id].pop(key)
+                        cache[env_id].pop(key)
 
                 if not is_eval:
                     step_in_dataset = erase_over_episodes(cache, limit)
                     logger.scalar(f"dataset_size", step_in_dataset)
                     logger.scalar(f"train_return", score)
-                    logger.scalar(f"train_length", length)
+                    logger.scalar(f"train_length", ep_length)
                     logger.scalar(f"train_episodes", len(cache))
                     logger.write(step=logger.step)
                 else:
@@ -715,20 +740,21 @@ def simulate(
                         eval_done = False
                     # start counting scores for evaluation
                     eval_scores.append(score)
-                    eval_lengths.append(length)
+                    eval_lengths.append(ep_length)
 
                     score = sum(eval_scores) / len(eval_scores)
-                    length = sum(eval_lengths) / len(eval_lengths)
-                    logger.video(f"eval_policy", np.array(video)[None])
+                    ep_length = sum(eval_lengths) / len(eval_lengths)
+                    logger.video(f"eval_policy", cache[env_id]["image"][None])
 
                     if len(eval_scores) >= episodes and not eval_done:
                         logger.scalar(f"eval_return", score)
-                        logger.scalar(f"eval_length", length)
+                        logger.scalar(f"eval_length", ep_length)
                         logger.scalar(f"eval_episodes", len(eval_scores))
                         logger.write(step=logger.step)
                         eval_done = True
 
-        print("Time taken for 1 simulation: ", (time.time()-start_time))
+        if _PROFILE:
+            print("Time taken for 1 simulation: ", (time.time() - start_time))
     if is_eval:
         # keep only last item for saving memory. this cache is used for video_pred later
         while len(cache) > 1:
@@ -788,9 +814,9 @@ def isaac_simulate(
         # step envs
         #result = [e.step(a) for e, a in zip(envs, action)]
         action = action[0]
-        print(action)
         action["action"] = action["action"].squeeze()
-        print(action)
+        if _DEBUG:
+            print(action)
         #action = action.squeeze()
         result = envs.step(action)
         # results = [r() for r in results]
@@ -870,48 +896,233 @@ def isaac_simulate(
             cache.popitem(last=False)
     return (step - steps, episode - episodes, done, length, obs, agent_state, reward)
 
+class _EpisodeArray:
+    """Append-only storage for one key of an episode in the cache.
+
+    Steps are written into one preallocated array that doubles when full,
+    instead of a list of per-step arrays that has to be stacked again for
+    every save and sample. Supports what the cache used lists for: len(),
+    append(), indexing, iteration and np.asarray(), which gives a view of
+    the filled rows.
+    """
+
+    def __init__(self, first, capacity=64):
+        first = np.asarray(first)
+        self._buf = np.empty((capacity,) + first.shape, first.dtype)
+        self._buf[0] = first
+        self._len = 1
+
+    def append(self, value):
+        if self._len == len(self._buf):
+            grown = np.empty((2 * self._len,) + self._buf.shape[1:], self._buf.dtype)
+            grown[: self._len] = self._buf
+            self._buf = grown
+        self._buf[self._len] = value
+        self._len += 1
+
+    def __len__(self):
+        return self._len
+
+    def __getitem__(self, index):
+        return self._buf[: self._len][index]
+
+    def __iter__(self):
+        return iter(self._buf[: self._len])
+
+    def __array__(self, dtype=None, copy=None):
+        value = self._buf[: self._len]
+        if dtype is not None:
+            return value.astype(dtype)
+        return value.copy() if copy else value
+
+
+def _finish_episode(cache, id):
+    # exact-size arrays for a finished episode, like the ones load_episodes
+    # gives, so the doubling slack is not kept around in the dataset
+    index = _dataset_index(cache)
+    cache[id] = {k: np.array(v) for k, v in cache[id].items()}
+    index.add(id, cache[id])
+
+
 def add_to_cache(cache, id, transition):
 
     if id not in cache:
         cache[id] = dict()
         for key, val in transition.items():
-            cache[id][key] = [convert(val)]
+            cache[id][key] = _EpisodeArray(convert(val))
     else:
         for key, val in transition.items():
+            val = convert(val)
             if key not in cache[id]:
                 # fill missing data(action, etc.) at second time
-                cache[id][key] = [convert(0 * val)]
-                #print("trying to convert ", val, " of type", type (val))
-                cache[id][key].append(convert(val))
-            else:
-                cache[id][key].append(convert(val))
+                cache[id][key] = _EpisodeArray(np.zeros_like(val))
+            cache[id][key].append(val)
+
+def _step_bookkeeping(done, length):
+    # advance the per-env lengths in place, restarting finished episodes
+    indices = np.flatnonzero(done)
+    length += 1
+    length[indices] = 0
+    return len(indices), indices
+
+
+def _running_returns(cache, ids, done):
+    # returns of the running episodes when resuming from a state tuple, envs
+    # that are done start a new episode on the next step
+    return np.array(
+        [
+            0.0 if d or id not in cache else float(np.sum(cache[id]["reward"]))
+            for id, d in zip(ids, done)
+        ],
+        np.float64,
+    )
 
-def erase_over_episodes(cache, dataset_size):
-    step_in_dataset = 0
-    for key, ep in reversed(sorted(cache.items(), key=lambda x: x[0])):
-        if (
-            not dataset_size
-            or step_in_dataset + (len(ep["reward"]) - 1) <= dataset_size
-        ):
-            step_in_dataset += len(ep["reward"]) - 1
+
+def _cache_initial(cache, vec, obs, done):
+    # start a cache episode for every finished env from the initial obs that
+    # is already in obs, returns the indices of those envs
+    indices = np.flatnonzero(done)
+    # action will be added to transition in add_to_cache_batched
+    add_to_cache_batched(
+        cache,
+        [vec.ids[index] for index in indices],
+        {k: convert(v[indices]) for k, v in obs.items()},
+        {},
+        np.zeros(len(indices), np.float32),
+        np.ones(len(indices), np.float32),
+    )
+    return indices
+
+
+def add_to_cache_batched(cache, ids, obs, action, reward, discount):
+    # every value holds one row per id, rows are copied into the episodes
+    for index, id in enumerate(ids):
+        new = id not in cache
+        if new:
+            cache[id] = dict()
+        episode = cache[id]
+        for values in (obs, action):
+            for key, val in values.items():
+                if new:
+                    episode[key] = _EpisodeArray(val[index])
+                    continue
+                if key not in episode:
+                    # fill missing data(action, etc.) at second time
+                    episode[key] = _EpisodeArray(np.zeros_like(val[index]))
+                episode[key].append(val[index])
+        if new:
+            episode["reward"] = _EpisodeArray(reward[index])
+            episode["discount"] = _EpisodeArray(discount[index])
         else:
-            del cache[key]
-    return step_in_dataset
+            episode["reward"].append(reward[index])
+            episode["discount"].append(discount[index])
+
+
+def _step_transitions(obs, action, reward, done, infos):
+    # convert the whole batch once instead of per env and key. Rows are
+    # copied into the cache, so the obs buffers are only copied when terminal
+    # obs have to be patched in
+    convert_obs = _convert_copy if done.any() else convert
+    obs = {k: convert_obs(v) for k, v in obs.items()}
+    for index in np.flatnonzero(done):
+        # obs was replaced by the first obs of the next episode
+        for k, v in infos[index]["terminal_obs"].items():
+            obs[k][index] = v
+    if isinstance(action, dict):
+        action = {k: convert(v) for k, v in action.items()}
+    else:
+        action = {"action": convert(action)}
+    discount = np.array(
+        [info.get("discount", 1 - float(d)) for info, d in zip(infos, done)],
+        np.float32,
+    )
+    return obs, action, convert(reward), discount
+
+
+def erase_over_episodes(cache, dataset_size):
+    # drop the oldest finished episodes until the stored steps fit
+    index = _dataset_index(cache)
+    while dataset_size and index.steps > dataset_size and index.keys:
+        key = index.keys.popleft()
+        index.steps -= index.lengths.pop(key)
+        cache.pop(key, None)
+    return index.steps
+
+
+class _DatasetIndex:
+    """Finished episodes of a cache, oldest first, and their total steps.
+
+    Built once from the episodes already in the cache, sorted by id, which
+    starts with the creation time. Episodes that finish later are newer than
+    all of those and are appended, so erase_over_episodes only has to pop
+    from the front instead of sorting the whole cache on every call.
+    """
+
+    def __init__(self, cache):
+        self.keys = collections.deque()
+        self.lengths = {}
+        self.steps = 0
+        # running episodes are still stored as _EpisodeArray and are added
+        # once _finish_episode is done with them
+        finished = [
+            key
+            for key, episode in cache.items()
+            if not isinstance(episode["reward"], _EpisodeArray)
+        ]
+        for key in sorted(finished):
+            self.add(key, cache[key])
+
+    def add(self, key, episode):
+        length = len(episode["reward"]) - 1
+        self.keys.append(key)
+        self.lengths[key] = length
+        self.steps += length
+
+
+def _dataset_index(cache):
+    index = getattr(cache, "_dataset_index", None)
+    if index is None:
+        index = cache._dataset_index = _DatasetIndex(cache)
+    return index
+
+
+_CONVERT_DTYPES = {
+    precision: {
+        "f": np.dtype({16: np.float16, 32: np.float32, 64: np.float64}[precision]),
+        "i": np.dtype({16: np.int16, 32: np.int32, 64: np.int64}[precision]),
+        "b": np.dtype(bool),
+    }
+    for precision in (16, 32, 64)
+}
+_CONVERT_SCALARS = {float: "f", bool: "b"}
 
 
 def convert(value, precision=32):
-    value = np.array(value)
-    if np.issubdtype(value.dtype, np.floating):
-        dtype = {16: np.float16, 32: np.float32, 64: np.float64}[precision]
-    elif np.issubdtype(value.dtype, np.signedinteger):
-        dtype = {16: np.int16, 32: np.int32, 64: np.int64}[precision]
-    elif np.issubdtype(value.dtype, np.uint8):
-        dtype = np.uint8
-    elif np.issubdtype(value.dtype, bool):
-        dtype = bool
-    else:
+    # arrays that already have the target dtype are returned as they are
+    dtypes = _CONVERT_DTYPES[precision]
+    if not isinstance(value, np.ndarray):
+        kind = _CONVERT_SCALARS.get(type(value))
+        if kind is not None:
+            return np.asarray(value, dtypes[kind])
+        value = np.asarray(value)
+    if value.dtype == np.uint8:
+        return value
+    dtype = dtypes.get(value.dtype.kind)
+    if dtype is None:
         raise NotImplementedError(value.dtype)
-    return value.astype(dtype)
+    return value.astype(dtype, copy=False)
+
+
+def _convert_copy(value):
+    # convert() may hand back its input; use this for buffers that get reused
+    result = convert(value)
+    return result.copy() if result is value else result
+
+
+# episodes are written from background threads so compression and disk io
+# stay off the simulation loop; flush_episodes() waits for pending writes
+_SAVE_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+_SAVE_PENDING = []
 
 
 def save_episodes(directory, episodes):
@@ -920,52 +1131,82 @@ def save_episodes(directory, episodes):
     for filename, episode in episodes.items():
         length = len(episode["reward"])
         filename = directory / f"{filename}-{length}.npz"
-        with io.BytesIO() as f1:
-            np.savez_compressed(f1, **episode)
-            f1.seek(0)
-            with filename.open("wb") as f2:
-                f2.write(f1.read())
+        # views of the filled rows, later appends and pops don't touch them
+        episode = {k: np.asarray(v) for k, v in episode.items()}
+        _SAVE_PENDING.append(_SAVE_POOL.submit(_write_episode, filename, episode))
+    # drop finished writes, re-raising their errors here
+    for future in [f for f in _SAVE_PENDING if f.done()]:
+        _SAVE_PENDING.remove(future)
+        future.result()
     return True
 
 
+def flush_episodes():
+    while _SAVE_PENDING:
+        _SAVE_PENDING.pop(0).result()
+
+
+def _write_episode(filename, episode):
+    # uncompressed, zlib on image data costs far more time than it saves space
+    with filename.open("wb") as f:
+        np.savez(f, **episode)
+
+
 def from_generator(generator, batch_size):
+    # Batches are written into buffers that are reused across yields, so a
+    # batch is only valid until the next one is requested. Consumers copy it
+    # to the device right away.
+    buffers = {}
     while True:
         batch = []
         for _ in range(batch_size):
             batch.append(next(generator))
         data = {}
         for key in batch[0].keys():
-            data[key] = []
+            first = np.asarray(batch[0][key])
+            buf = buffers.get(key)
+            if buf is None or buf.shape[1:] != first.shape or buf.dtype != first.dtype:
+                buf = buffers[key] = np.empty((batch_size,) + first.shape, first.dtype)
             for i in range(batch_size):
-                data[key].append(batch[i][key])
-            data[key] = np.stack(data[key], 0)
+                buf[i] = batch[i][key]
+            data[key] = buf
         yield data
 
 
 def sample_episodes(episodes, length, seed=0):
-    np_random = np.random.RandomState(seed)
+    np_random = np.random.default_rng(seed)
 
     while True:
         size = 0
         ret = None
-        p = np.array(
-            [len(next(iter(episode.values()))) for episode in episodes.values()]
+        values = list(episodes.values())
+        # length-weighted choice through one cumsum per sequence, shared by
+        # all draws for it. Running episodes keep growing in between, so the
+        # lengths can't be kept across sequences.
+        cdf = np.cumsum(
+            np.fromiter(
+                (len(next(iter(episode.values()))) for episode in values),
+                np.int64,
+                len(values),
+            )
         )
-        p = p / np.sum(p)
         while size < length:
-            episode = np_random.choice(list(episodes.values()), p=p)
+            index = cdf.searchsorted(np_random.random() * cdf[-1], side="right")
+            episode = values[int(index)]
             total = len(next(iter(episode.values())))
             # make sure at least one transition included
             if total < 2:
                 continue
             if not ret:
-                index = int(np_random.randint(0, total - 1))
+                index = int(np_random.integers(0, total - 1))
                 ret = {
                     k: v[index : min(index + length, total)]
                     for k, v in episode.items()
                     if "log_" not in k
                 }
                 if "is_first" in ret:
+                    # the slice is a view into the cache, mark a copy
+                    ret["is_first"] = np.array(ret["is_first"])
                     ret["is_first"][0] = True
             else:
                 # 'is_first' comes after 'is_last'
@@ -988,36 +1229,46 @@ def load_episodes(directory, limit=None, reverse=True):
     directory = pathlib.Path(directory).expanduser()
     episodes = collections.OrderedDict()
     total = 0
+    filenames = sorted(directory.glob("*.npz"))
     if reverse:
-        for filename in reversed(sorted(directory.glob("*.npz"))):
-            try:
-                with filename.open("rb") as f:
-                    episode = np.load(f)
-                    episode = {k: episode[k] for k in episode.keys()}
-            except Exception as e:
-                print(f"Could not load episode: {e}")
-                continue
-            # extract only filename without extension
-            episodes[str(os.path.splitext(os.path.basename(filename))[0])] = episode
-            total += len(episode["reward"]) - 1
-            if limit and total >= limit:
-                break
-    else:
-        for filename in sorted(directory.glob("*.npz")):
+        filenames = filenames[::-1]
+    filenames = iter(filenames)
+    # files are read by a thread pool a few ahead of the one being added, in
+    # order, so limit still stops at the same episode as a sequential load
+    workers = os.cpu_count() or 1
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = collections.deque(
+            (filename, pool.submit(_load_episode, filename))
+            for filename in itertools.islice(filenames, 2 * workers)
+        )
+        while pending:
+            filename, future = pending.popleft()
+            for ahead in itertools.islice(filenames, 1):
+                pending.append((ahead, pool.submit(_load_episode, ahead)))
             try:
-                with filename.open("rb") as f:
-                    episode = np.load(f)
-                    episode = {k: episode[k] for k in episode.keys()}
+                episode = future.result()
             except Exception as e:
                 print(f"Could not load episode: {e}")
                 continue
-            episodes[str(filename)] = episode
+            if reverse:
+                # extract only filename without extension
+                episodes[str(os.path.splitext(os.path.basename(filename))[0])] = episode
+            else:
+                episodes[str(filename)] = episode
             total += len(episode["reward"]) - 1
             if limit and total >= limit:
+                for _, future in pending:
+                    future.cancel()
                 break
     return episodes
 
 
+def _load_episode(filename):
+    with filename.open("rb") as f:
+        episode = np.load(f)
+        return {k: episode[k] for k in episode.keys()}
+
+
 class SampleDist:
     def __init__(self, dist, samples=100):
         self._dist = dist
@@ -1035,9 +1286,13 @@ class SampleDist:
         return torch.mean(samples, 0)
 
     def mode(self):
-        sample = self._dist.sample(self._samples)
+        # most likely of the samples, chosen per batch entry
+        sample = self._dist.sample((self._samples,))
         logprob = self._dist.log_prob(sample)
-        return sample[torch.argmax(logprob)][0]
+        index = torch.argmax(logprob, 0)
+        event = (1,) * (sample.dim() - logprob.dim())
+        index = index.reshape((1,) + index.shape + event)
+        return sample.gather(0, index.expand((1,) + sample.shape[1:])).squeeze(0)
 
     def entropy(self):
         sample = self._dist.sample(self._samples)
@@ -1048,9 +1303,14 @@ class SampleDist:
 class OneHotDist(torchd.one_hot_categorical.OneHotCategorical):
     def __init__(self, logits=None, probs=None, unimix_ratio=0.0):
         if logits is not None and unimix_ratio > 0.0:
-            probs = F.softmax(logits, dim=-1)
-            probs = probs * (1.0 - unimix_ratio) + unimix_ratio / probs.shape[-1]
-            logits = torch.log(probs)
+            # mix with the uniform in log space:
+            # log((1 - u) * softmax(logits) + u / n) without going through probs
+            log_probs = F.log_softmax(logits, dim=-1)
+            uniform = math.log(unimix_ratio / log_probs.shape[-1])
+            logits = torch.logaddexp(
+                log_probs + math.log(1.0 - unimix_ratio),
+                torch.full_like(log_probs, uniform),
+            )
             super().__init__(logits=logits, probs=None)
         else:
             super().__init__(logits=logits, probs=probs)
@@ -1065,13 +1325,16 @@ class OneHotDist(torchd.one_hot_categorical.OneHotCategorical):
         if seed is not None:
             raise ValueError("need to check")
         sample = super().sample(sample_shape)
+        # straight-through gradient, probs broadcast over sample_shape
         probs = super().probs
-        while len(probs.shape) < len(sample.shape):
-            probs = probs[None]
         sample += probs - probs.detach()
         return sample
 
 
+# (buckets, width) per (low, high, device), built once instead of per instance
+_BUCKET_CACHE = {}
+
+
 class DiscDist:
     def __init__(
         self,
@@ -1084,8 +1347,11 @@ class DiscDist:
     ):
         self.logits = logits
         self.probs = torch.softmax(logits, -1)
-        self.buckets = torch.linspace(low, high, steps=255).to(device)
-        self.width = (self.buckets[-1] - self.buckets[0]) / 255
+        key = (low, high, str(device))
+        if key not in _BUCKET_CACHE:
+            buckets = torch.linspace(low, high, steps=255, device=device)
+            _BUCKET_CACHE[key] = (buckets, (buckets[-1] - buckets[0]) / 255)
+        self.buckets, self.width = _BUCKET_CACHE[key]
         self.transfwd = transfwd
         self.transbwd = transbwd
 
@@ -1099,29 +1365,23 @@ class DiscDist:
 
     # Inside OneHotCategorical, log_prob is calculated using only max element in targets
     def log_prob(self, x):
-        x = self.transfwd(x)
-        # x(time, batch, 1)
-        below = torch.sum((self.buckets <= x[..., None]).to(torch.int32), dim=-1) - 1
-        above = len(self.buckets) - torch.sum(
-            (self.buckets > x[..., None]).to(torch.int32), dim=-1
-        )
-        below = torch.clip(below, 0, len(self.buckets) - 1)
+        # x is (time, batch) or (time, batch, 1), gather wants a trailing 1
+        x = self.transfwd(x).reshape(self.logits.shape[:-1] + (1,))
+        # index of the first bucket above x, found by binary search instead of
+        # comparing x against every bucket
+        above = torch.searchsorted(self.buckets, x.contiguous(), right=True)
+        below = torch.clip(above - 1, 0, len(self.buckets) - 1)
         above = torch.clip(above, 0, len(self.buckets) - 1)
         equal = below == above
+        # (..., 2): both neighbours handled by one lookup and one gather
+        index = torch.cat([below, above], -1)
 
-        dist_to_below = torch.where(equal, 1, torch.abs(self.buckets[below] - x))
-        dist_to_above = torch.where(equal, 1, torch.abs(self.buckets[above] - x))
-        total = dist_to_below + dist_to_above
-        weight_below = dist_to_above / total
-        weight_above = dist_to_below / total
-        target = (
-            F.one_hot(below, num_classes=len(self.buckets)) * weight_below[..., None]
-            + F.one_hot(above, num_classes=len(self.buckets)) * weight_above[..., None]
-        )
-        log_pred = self.logits - torch.logsumexp(self.logits, -1, keepdim=True)
-        target = target.squeeze(-2)
-
-        return (target * log_pred).sum(-1)
+        dist = torch.where(equal, 1, torch.abs(self.buckets[index] - x))
+        # each neighbour is weighted by the distance to the other one
+        weight = dist.flip(-1) / dist.sum(-1, keepdim=True)
+        log_pred = F.log_softmax(self.logits, -1)
+        # the two-hot target only has two nonzero entries, gather them directly
+        return (weight * log_pred.gather(-1, index)).sum(-1)
 
     def log_prob_target(self, target):
         log_pred = super().logits - torch.logsumexp(super().logits, -1, keepdim=True)
@@ -1152,7 +1412,7 @@ class MSEDist:
 
 
 class SymlogDist:
-    def __init__(self, mode, dist="mse", agg="sum", tol=1e-8):
+    def __init__(self, mode, dist="mse", agg="sum", tol=0.0):
         self._mode = mode
         self._dist = dist
         self._agg = agg
@@ -1168,12 +1428,14 @@ class SymlogDist:
         assert self._mode.shape == value.shape
         if self._dist == "mse":
             distance = (self._mode - symlog(value)) ** 2.0
-            distance = torch.where(distance < self._tol, 0, distance)
         elif self._dist == "abs":
             distance = torch.abs(self._mode - symlog(value))
-            distance = torch.where(distance < self._tol, 0, distance)
         else:
             raise NotImplementedError(self._dist)
+        if self._tol:
+            # off by default, zeroing distances this small does not change
+            # the fp32 loss and costs a mask and a where per call
+            distance = torch.where(distance < self._tol, 0, distance)
         if self._agg == "mean":
             loss = distance.mean(list(range(len(distance.shape)))[2:])
         elif self._agg == "sum":
@@ -1225,11 +1487,10 @@ class Bernoulli:
         return self._dist.rsample(sample_shape)
 
     def log_prob(self, x):
-        _logits = self._dist.base_dist.logits
-        log_probs0 = -F.softplus(_logits)
-        log_probs1 = -F.softplus(-_logits)
-
-        return log_probs0 * (1 - x) + log_probs1 * x
+        # elementwise x * log(p) + (1 - x) * log(1 - p) in one fused kernel,
+        # which needs logits and targets of the same shape
+        _logits, x = torch.broadcast_tensors(self._dist.base_dist.logits, x)
+        return -F.binary_cross_entropy_with_logits(_logits, x, reduction="none")
 
 
 class UnnormalizedHuber(torchd.normal.Normal):
@@ -1273,35 +1534,44 @@ class TanhBijector(torchd.Transform):
         return torch.tanh(x)
 
     def _inverse(self, y):
-        y = torch.where(
-            (torch.abs(y) <= 1.0), torch.clamp(y, -0.99999997, 0.99999997), y
-        )
-        y = torch.atanh(y)
-        return y
+        return _tanh_inverse(y)
 
     def _forward_log_det_jacobian(self, x):
-        log2 = torch.math.log(2.0)
-        return 2.0 * (log2 - x - torch.softplus(-2.0 * x))
+        return _tanh_log_det_jacobian(x)
 
 
-def static_scan_for_lambda_return(fn, inputs, start):
-    last = start
-    indices = range(inputs[0].shape[0])
-    indices = reversed(indices)
-    flag = True
-    for index in indices:
-        # (inputs, pcont) -> (inputs[index], pcont[index])
-        inp = lambda x: (_input[x] for _input in inputs)
-        last = fn(last, *inp(index))
-        if flag:
-            outputs = last
-            flag = False
-        else:
-            outputs = torch.cat([outputs, last], dim=-1)
-    outputs = torch.reshape(outputs, [outputs.shape[0], outputs.shape[1], 1])
-    outputs = torch.flip(outputs, [1])
-    outputs = torch.unbind(outputs, dim=0)
-    return outputs
+@torch.jit.script
+def _tanh_inverse(y: torch.Tensor) -> torch.Tensor:
+    y = torch.where(
+        torch.abs(y) <= 1.0, torch.clamp(y, -0.99999997, 0.99999997), y
+    )
+    # atanh(y)
+    return 0.5 * (torch.log1p(y) - torch.log1p(-y))
+
+
+@torch.jit.script
+def _tanh_log_det_jacobian(x: torch.Tensor) -> torch.Tensor:
+    # log(1 - tanh(x)^2) = 2 * (log(2) - x - softplus(-2x))
+    return 2.0 * (0.6931471805599453 - x - F.softplus(-2.0 * x))
+
+
+def _discounted_sum(inputs, discount, bootstrap):
+    # Solves x_t = inputs_t + discount_t * x_{t+1} with x_T = bootstrap over
+    # the whole horizon at once: x_t = sum_{k>=t} prod(discount[t:k]) * v_k
+    # with v = [inputs, bootstrap]. The products come from one cumprod over a
+    # (T, T) grid that is 1 below the diagonal, which stays exact when the
+    # discount hits zero, unlike dividing cumulative products.
+    T = inputs.shape[0]
+    trailing = (1,) * (inputs.dim() - 1)
+    rows = torch.arange(T, device=inputs.device)
+    cols = torch.arange(T + 1, device=inputs.device)
+    upper = (cols[None, :] >= rows[:, None]).view((T, T + 1) + trailing)
+    grid = torch.where(upper[:, :T], discount[None], discount.new_ones(()))
+    prods = torch.cumprod(grid, 1)
+    # (T, T + 1, ...): entry [t, k] is prod(discount[t:k])
+    prods = torch.cat([torch.ones_like(prods[:, :1]), prods], 1)
+    values = torch.cat([inputs, bootstrap[None]], 0)
+    return (prods * upper.to(prods.dtype) * values[None]).sum(1)
 
 
 def lambda_return(reward, value, pcont, bootstrap, lambda_, axis):
@@ -1321,16 +1591,13 @@ def lambda_return(reward, value, pcont, bootstrap, lambda_, axis):
         bootstrap = torch.zeros_like(value[-1])
     next_values = torch.cat([value[1:], bootstrap[None]], 0)
     inputs = reward + pcont * next_values * (1 - lambda_)
-    # returns = static_scan(
-    #    lambda agg, cur0, cur1: cur0 + cur1 * lambda_ * agg,
-    #    (inputs, pcont), bootstrap, reverse=True)
-    # reimplement to optimize performance
-    returns = static_scan_for_lambda_return(
-        lambda agg, cur0, cur1: cur0 + cur1 * lambda_ * agg, (inputs, pcont), bootstrap
-    )
+    # returns_t = inputs_t + pcont_t * lambda_ * returns_{t+1}, solved without
+    # stepping through time
+    returns = _discounted_sum(inputs, pcont * lambda_, bootstrap)
     if axis != 0:
         returns = returns.permute(dims)
-    return returns
+    # one (time, 1) tensor per batch entry, callers stack them on dim 1
+    return torch.unbind(returns, dim=1)
 
 
 class Optimizer:
@@ -1349,42 +1616,66 @@ class Optimizer:
         assert 0 <= wd < 1
         assert not clip or 1 <= clip
         self._name = name
-        self._parameters = parameters
+        self._parameters = parameters = list(parameters)
         self._clip = clip
         self._wd = wd
         self._wd_pattern = wd_pattern
-        self._opt = {
-            "adam": lambda: torch.optim.Adam(parameters, lr=lr, eps=eps),
-            "nadam": lambda: NotImplemented(f"{opt} is not implemented"),
+        if opt == "nadam":
+            raise NotImplementedError(f"{opt} is not implemented")
+        # built on the first update, once the model has been moved to its
+        # device, so adam can use the fused kernel for cuda parameters
+        self._make_opt = {
+            "adam": lambda: torch.optim.Adam(
+                parameters, lr=lr, eps=eps, **self._fused()
+            ),
             "adamax": lambda: torch.optim.Adamax(parameters, lr=lr, eps=eps),
             "sgd": lambda: torch.optim.SGD(parameters, lr=lr),
             "momentum": lambda: torch.optim.SGD(parameters, lr=lr, momentum=0.9),
-        }[opt]()
+        }[opt]
+        self._opt = None
+        self._use_amp = use_amp
         self._scaler = torch.cuda.amp.GradScaler(enabled=use_amp)
 
     def __call__(self, loss, params, retain_graph=False):
         assert len(loss.shape) == 0, loss.shape
+        if self._opt is None:
+            self._opt = self._make_opt()
+        # params is usually a generator and is used twice below
+        params = list(params)
         metrics = {}
-        metrics[f"{self._name}_loss"] = loss.detach().cpu().numpy()
-        self._scaler.scale(loss).backward()
-        self._scaler.unscale_(self._opt)
+        if self._use_amp:
+            self._scaler.scale(loss).backward()
+            self._scaler.unscale_(self._opt)
+        else:
+            loss.backward()
         # loss.backward(retain_graph=retain_graph)
         norm = torch.nn.utils.clip_grad_norm_(params, self._clip)
         if self._wd:
             self._apply_weight_decay(params)
-        self._scaler.step(self._opt)
-        self._scaler.update()
-        # self._opt.step()
+        if self._use_amp:
+            self._scaler.step(self._opt)
+            self._scaler.update()
+        else:
+            self._opt.step()
         self._opt.zero_grad()
-        metrics[f"{self._name}_grad_norm"] = norm.item()
+        # one device to host copy for both metrics, issued after the update so
+        # it does not stall launching backward and step
+        values = torch.stack([loss.detach().float(), norm.detach().float()]).cpu()
+        metrics[f"{self._name}_loss"] = values[0].numpy()
+        metrics[f"{self._name}_grad_norm"] = values[1].item()
         return metrics
 
     def _apply_weight_decay(self, varibs):
         nontrivial = self._wd_pattern != r".*"
         if nontrivial:
             raise NotImplementedError
-        for var in varibs:
-            var.data = (1 - self._wd) * var.data
+        torch._foreach_mul_([var.data for var in varibs], 1 - self._wd)
+
+    def _fused(self):
+        # the fused kernel needs every parameter as a floating point cuda tensor
+        if all(p.is_cuda and torch.is_floating_point(p) for p in self._parameters):
+            return {"fused": True}
+        return {}
 
 
 def args_type(default):
@@ -1409,48 +1700,31 @@ def args_type(default):
 
 def static_scan(fn, inputs, start):
     last = start
-    indices = range(inputs[0].shape[0])
-    flag = True
-    for index in indices:
+    outputs, slots = None, None
+    for index in range(inputs[0].shape[0]):
         inp = lambda x: (_input[x] for _input in inputs)
         last = fn(last, *inp(index))
-        if flag:
-            if type(last) == type({}):
-                outputs = {
-                    key: value.clone().unsqueeze(0) for key, value in last.items()
-                }
-            else:
-                outputs = []
-                for _last in last:
-                    if type(_last) == type({}):
-                        outputs.append(
-                            {
-                                key: value.clone().unsqueeze(0)
-                                for key, value in _last.items()
-                            }
-                        )
-                    else:
-                        outputs.append(_last.clone().unsqueeze(0))
-            flag = False
+        items = [last] if type(last) == type({}) else last
+        if slots is None:
+            # (output, key, steps) per leaf, worked out from the first step so
+            # the dict/list dispatch only happens once
+            outputs, slots = [], []
+            for j, item in enumerate(items):
+                if type(item) == type({}):
+                    slots += [(j, k, []) for k in item.keys()]
+                    outputs.append({})
+                else:
+                    slots.append((j, None, []))
+                    outputs.append(None)
+        for j, key, steps in slots:
+            steps.append(items[j] if key is None else items[j][key])
+    # one stack per leaf instead of growing every field with torch.cat, O(T)
+    # in both forward and backward
+    for j, key, steps in slots:
+        if key is None:
+            outputs[j] = torch.stack(steps, 0)
         else:
-            if type(last) == type({}):
-                for key in last.keys():
-                    outputs[key] = torch.cat(
-                        [outputs[key], last[key].unsqueeze(0)], dim=0
-                    )
-            else:
-                for j in range(len(outputs)):
-                    if type(last[j]) == type({}):
-                        for key in last[j].keys():
-                            outputs[j][key] = torch.cat(
-                                [outputs[j][key], last[j][key].unsqueeze(0)], dim=0
-                            )
-                    else:
-                        outputs[j] = torch.cat(
-                            [outputs[j], last[j].unsqueeze(0)], dim=0
-                        )
-    if type(last) == type({}):
-        outputs = [outputs]
+            outputs[j][key] = torch.stack(steps, 0)
     return outputs
 
 
@@ -1522,34 +1796,52 @@ class Until:
         return step < self._until
 
 
-def schedule(string, step):
+_SCHEDULES = {
+    "linear": re.compile(r"linear\((.+),(.+),(.+)\)"),
+    "warmup": re.compile(r"warmup\((.+),(.+)\)"),
+    "exp": re.compile(r"exp\((.+),(.+),(.+)\)"),
+    "horizon": re.compile(r"horizon\((.+),(.+),(.+)\)"),
+}
+
+
+@functools.lru_cache(maxsize=32)
+def _parse_schedule(string):
+    # (kind, params) of a schedule string, parsed once per distinct string
     try:
-        return float(string)
+        return "constant", (float(string),)
     except ValueError:
-        match = re.match(r"linear\((.+),(.+),(.+)\)", string)
-        if match:
-            initial, final, duration = [float(group) for group in match.groups()]
-            mix = torch.clip(torch.Tensor([step / duration]), 0, 1)[0]
-            return (1 - mix) * initial + mix * final
-        match = re.match(r"warmup\((.+),(.+)\)", string)
-        if match:
-            warmup, value = [float(group) for group in match.groups()]
-            scale = torch.clip(step / warmup, 0, 1)
-            return scale * value
-        match = re.match(r"exp\((.+),(.+),(.+)\)", string)
+        pass
+    for kind, pattern in _SCHEDULES.items():
+        match = pattern.match(string)
         if match:
-            initial, final, halflife = [float(group) for group in match.groups()]
-            return (initial - final) * 0.5 ** (step / halflife) + final
-        match = re.match(r"horizon\((.+),(.+),(.+)\)", string)
-        if match:
-            initial, final, duration = [float(group) for group in match.groups()]
-            mix = torch.clip(step / duration, 0, 1)
-            horizon = (1 - mix) * initial + mix * final
-            return 1 - 1 / horizon
-        raise NotImplementedError(string)
+            return kind, tuple(float(group) for group in match.groups())
+    raise NotImplementedError(string)
 
 
-def weight_init(m):
+def schedule(string, step):
+    # called every train step, so plain float math instead of tensors
+    kind, params = _parse_schedule(string)
+    if kind == "constant":
+        return params[0]
+    if kind == "linear":
+        initial, final, duration = params
+        mix = min(max(step / duration, 0.0), 1.0)
+        return (1 - mix) * initial + mix * final
+    if kind == "warmup":
+        warmup, value = params
+        scale = min(max(step / warmup, 0.0), 1.0)
+        return scale * value
+    if kind == "exp":
+        initial, final, halflife = params
+        return (initial - final) * 0.5 ** (step / halflife) + final
+    initial, final, duration = params
+    mix = min(max(step / duration, 0.0), 1.0)
+    horizon = (1 - mix) * initial + mix * final
+    return 1 - 1 / horizon
+
+
+def _trunc_normal_weight(m):
+    # draws the weight of linear and conv layers, True if m is one of them
     if isinstance(m, nn.Linear):
         in_num = m.in_features
         out_num = m.out_features
@@ -1559,8 +1851,6 @@ def weight_init(m):
         nn.init.trunc_normal_(
             m.weight.data, mean=0.0, std=std, a=-2.0 * std, b=2.0 * std
         )
-        if hasattr(m.bias, "data"):
-            m.bias.data.fill_(0.0)
     elif isinstance(m, nn.Conv2d) or isinstance(m, nn.ConvTranspose2d):
         space = m.kernel_size[0] * m.kernel_size[1]
         in_num = space * m.in_channels
@@ -1569,6 +1859,13 @@ def weight_init(m):
         scale = 1.0 / denoms
         std = np.sqrt(scale) / 0.87962566103423978
         nn.init.trunc_normal_(m.weight.data, mean=0.0, std=std, a=-2.0, b=2.0)
+    else:
+        return False
+    return True
+
+
+def weight_init(m):
+    if _trunc_normal_weight(m):
         if hasattr(m.bias, "data"):
             m.bias.data.fill_(0.0)
     elif isinstance(m, nn.LayerNorm):
@@ -1577,6 +1874,25 @@ def weight_init(m):
             m.bias.data.fill_(0.0)
 
 
+@torch.no_grad()
+def init_weights(module):
+    # Same result as module.apply(weight_init), including the random draws,
+    # but all biases are zeroed with one foreach call instead of a fill per
+    # tensor.
+    zeros, ones = [], []
+    for m in module.modules():
+        if isinstance(m, nn.LayerNorm):
+            ones.append(m.weight.data)
+        elif not _trunc_normal_weight(m):
+            continue
+        if hasattr(m.bias, "data"):
+            zeros.append(m.bias.data)
+    if zeros:
+        torch._foreach_zero_(zeros)
+    for weight in ones:
+        weight.fill_(1.0)
+
+
 def uniform_weight_init(given_scale):
     def f(m):
         if isinstance(m, nn.Linear):